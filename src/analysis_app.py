@@ -5,16 +5,20 @@ import itertools
 import json
 import os
 import sys
+import time
 
 import requests
 
-from collections import defaultdict
+from collections import defaultdict, deque
+from contextlib import ExitStack
 from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
 from keboola import docker
 
-from kbc_tools import read_csv, csv_writer, slice_stream, make_batch_request, parallel_map, serialize_data
+from kbc_tools import read_csv, csv_writer, slice_stream, post_batch_request, parallel_map, serialize_data, \
+    reservoir_stream, count_batch_requests, pack_batch, split_text, doc_size, columnar_writer, \
+    MAX_REQ_SIZE, RECORD_BATCH_SIZE
 
 BASE_URL = 'https://api.geneea.com/keboola/v2/analysis'
 BETA_URL = 'https://beta-api.geneea.com/keboola/v2/analysis'
@@ -27,6 +31,21 @@ OUT_TAB_ENT = 'analysis-result-entities.csv'
 OUT_TAB_REL = 'analysis-result-relations.csv'
 OUT_TAB_FULL = 'analysis-result-full.csv'
 
+OUTPUT_FORMATS = {
+    'csv': '.csv',
+    'parquet': '.parquet',
+    'arrow': '.arrows'
+}
+COLUMN_TYPES = {
+    'usedChars': 'int',
+    'index': 'int',
+    'score': 'float',
+    'negated': 'bool',
+    'sentimentValue': 'float',
+    'sentimentPolarity': 'int'
+}
+DICT_COLUMNS = ('type', 'segment', 'sentimentLabel', 'language')
+
 META_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'meta')
 META_DESC_KEY = 'KBC.description'
 
@@ -61,6 +80,9 @@ class Params:
         self.doc_batch_size = int(advanced_params.get('doc_batch_size', DOC_BATCH_SIZE))
         self.thread_count = int(advanced_params.get('thread_count', THREAD_COUNT))
         self.reference_date = advanced_params.get('reference_date')
+        self.preview_rows = int(advanced_params.get('preview_rows', 0))
+        self.output_format = str(advanced_params.get('output_format', 'csv')).lower()
+        self.record_batch_size = int(advanced_params.get('record_batch_size', RECORD_BATCH_SIZE))
 
         self.validate()
 
@@ -119,12 +141,23 @@ class Params:
                 raise ValueError('invalid "column.id" parameter, value "{col}" is a reserved name'.format(col=id_col))
         if self.thread_count > 32:
             raise ValueError('the "thread_count" parameter can not be greater than 32')
+        if self.preview_rows < 0:
+            raise ValueError('the "preview_rows" parameter can not be negative')
+        if self.output_format not in OUTPUT_FORMATS:
+            raise ValueError('the "output_format" parameter has to be one of: {formats}'.format(
+                    formats=', '.join(sorted(OUTPUT_FORMATS))))
+        if self.record_batch_size < 1:
+            raise ValueError('the "record_batch_size" parameter has to be positive')
 
     def get_output_path(self, filename):
         return os.path.normpath(os.path.join(
                 self.config.get_data_dir(), 'out', 'tables', filename
         ))
 
+    def get_table_path(self, filename):
+        name, _ = os.path.splitext(filename)
+        return self.get_output_path(name + OUTPUT_FORMATS[self.output_format])
+
     def get_usage_path(self):
         return os.path.normpath(os.path.join(
                 self.config.get_data_dir(), 'out', 'usage.json'
@@ -165,29 +198,64 @@ class AnalysisApp:
                     raise ValueError('the source table does not contain column "{col}"'.format(col=col))
 
     def run(self):
+        if self.params.preview_rows:
+            self.run_preview()
+            return
+
         print('starting NLP analysis of user-feedback comments')
         sys.stdout.flush()
+        with open(self.params.source_tab_path, 'r', encoding='utf-8') as in_tab:
+            doc_count, used_chars = self.analyze_to_tables(read_csv(in_tab))
+
+        print('the analysis has finished successfully, {n} documents with {ch} characters were analyzed'.format(n=doc_count, ch=used_chars))
+        sys.stdout.flush()
+
+    def run_preview(self):
+        print('starting a preview NLP analysis of {n} sampled user-feedback comments'.format(n=self.params.preview_rows))
+        sys.stdout.flush()
+
+        sample = []
+        total_chars = 0
+        total_req_count = 0
+        with open(self.params.source_tab_path, 'r', encoding='utf-8') as in_tab:
+            row_stream = reservoir_stream(read_csv(in_tab), self.params.preview_rows, sample)
+            for batch in self.doc_batch_stream(row_stream):
+                total_chars += self.count_batch_chars(batch)
+                total_req_count += count_batch_requests(batch)
+        sample_req_count = sum(count_batch_requests(batch) for batch in self.doc_batch_stream(iter(sample)))
+
+        start = time.monotonic()
+        doc_count, used_chars = self.analyze_to_tables(iter(sample))
+        elapsed = time.monotonic() - start
+
+        print('the preview analysis has finished successfully, {n} documents with {ch} characters were analyzed in {s:.1f} seconds'.format(
+            n=doc_count, ch=used_chars, s=elapsed))
+        print('the full table has {ch} characters and would need {r} API requests'.format(ch=total_chars, r=total_req_count))
+        if sample_req_count:
+            # the sample may run with fewer concurrent requests than the full analysis
+            req_time = elapsed * min(self.params.thread_count, sample_req_count) / sample_req_count
+            estimate = req_time * total_req_count / min(self.params.thread_count, total_req_count)
+            print('the estimated time of the full analysis is {s:.0f} seconds (using {t} threads)'.format(
+                s=estimate, t=self.params.thread_count))
+        sys.stdout.flush()
+
+    def analyze_to_tables(self, row_stream):
         doc_count = 0
         used_chars = 0
 
-        out_tab_doc_path = self.params.get_output_path(OUT_TAB_DOC)
-        out_tab_snt_path = self.params.get_output_path(OUT_TAB_SNT)
-        out_tab_ent_path = self.params.get_output_path(OUT_TAB_ENT)
-        out_tab_rel_path = self.params.get_output_path(OUT_TAB_REL)
-        out_tab_full_path = self.params.get_output_path(OUT_TAB_FULL)
-        with open(self.params.source_tab_path, 'r', encoding='utf-8') as in_tab, \
-             open(out_tab_doc_path, 'w', encoding='utf-8') as out_tab_doc, \
-             open(out_tab_snt_path, 'w', encoding='utf-8') as out_tab_snt, \
-             open(out_tab_ent_path, 'w', encoding='utf-8') as out_tab_ent, \
-             open(out_tab_rel_path, 'w', encoding='utf-8') as out_tab_rel, \
-             open(out_tab_full_path, 'w', encoding='utf-8') as out_tab_full:
-            doc_writer = csv_writer(out_tab_doc, fields=self.get_doc_tab_fields())
-            snt_writer = csv_writer(out_tab_snt, fields=self.get_snt_tab_fields())
-            ent_writer = csv_writer(out_tab_ent, fields=self.get_ent_tab_fields())
-            rel_writer = csv_writer(out_tab_rel, fields=self.get_rel_tab_fields())
-            full_writer = csv_writer(out_tab_full, fields=self.get_full_tab_fields())
-
-            for batch_analysis in self.analyze(read_csv(in_tab)):
+        out_tab_doc_path = self.params.get_table_path(OUT_TAB_DOC)
+        out_tab_snt_path = self.params.get_table_path(OUT_TAB_SNT)
+        out_tab_ent_path = self.params.get_table_path(OUT_TAB_ENT)
+        out_tab_rel_path = self.params.get_table_path(OUT_TAB_REL)
+        out_tab_full_path = self.params.get_table_path(OUT_TAB_FULL)
+        with ExitStack() as stack:
+            doc_writer = self.open_table_writer(stack, out_tab_doc_path, fields=self.get_doc_tab_fields())
+            snt_writer = self.open_table_writer(stack, out_tab_snt_path, fields=self.get_snt_tab_fields())
+            ent_writer = self.open_table_writer(stack, out_tab_ent_path, fields=self.get_ent_tab_fields())
+            rel_writer = self.open_table_writer(stack, out_tab_rel_path, fields=self.get_rel_tab_fields())
+            full_writer = self.open_table_writer(stack, out_tab_full_path, fields=self.get_full_tab_fields())
+
+            for batch_analysis in self.analyze(row_stream):
                 for doc_analysis in self.proc_batch_analysis(batch_analysis):
                     doc_writer.writerows(self.analysis_to_doc_result(doc_analysis))
                     snt_writer.writerows(self.analysis_to_snt_result(doc_analysis))
@@ -206,25 +274,46 @@ class AnalysisApp:
         self.write_manifest(doc_tab_path=out_tab_doc_path, snt_tab_path=out_tab_snt_path,
                             ent_tab_path=out_tab_ent_path, rel_tab_path=out_tab_rel_path,
                             full_tab_path=out_tab_full_path)
-
-        print('the analysis has finished successfully, {n} documents with {ch} characters were analyzed'.format(n=doc_count, ch=used_chars))
-        sys.stdout.flush()
+        return doc_count, used_chars
+
+    def open_table_writer(self, stack, path, *, fields):
+        if self.params.output_format == 'csv':
+            out_tab = stack.enter_context(open(path, 'w', encoding='utf-8'))
+            return csv_writer(out_tab, fields=fields)
+        return stack.enter_context(columnar_writer(
+            path, fields=fields, fmt=self.params.output_format, types=COLUMN_TYPES,
+            dict_fields=DICT_COLUMNS, batch_size=self.params.record_batch_size
+        ))
 
     def analyze(self, row_stream):
         url = BASE_URL if not self.params.use_beta else BETA_URL
         user_key = self.params.user_key
         req = self.get_request()
 
-        batch_stream = self.doc_batch_stream(row_stream)
+        chunk_counts = deque()
+        def chunk_stream():
+            for batch in self.doc_batch_stream(row_stream):
+                chunks = list(pack_batch(batch))
+                if chunks:
+                    chunk_counts.append(len(chunks))
+                    yield from chunks
 
         with requests.Session() as session:
             with ThreadPoolExecutor(max_workers=self.params.thread_count) as executor:
-                for batch_analysis in parallel_map(
-                    executor, make_batch_request,
-                    batch_stream, itertools.repeat(req), url=url, user_key=user_key,
+                pending = 0
+                batch_analysis = []
+                for chunk_analysis in parallel_map(
+                    executor, post_batch_request,
+                    chunk_stream(), itertools.repeat(req), url=url, user_key=user_key,
                     session=session
                 ):
-                    yield batch_analysis
+                    if pending == 0:
+                        pending = chunk_counts.popleft()
+                    batch_analysis += chunk_analysis
+                    pending -= 1
+                    if pending == 0:
+                        yield self.join_batch_parts(batch_analysis)
+                        batch_analysis = []
 
     def get_request(self):
         req = {
@@ -243,7 +332,10 @@ class AnalysisApp:
 
     def doc_batch_stream(self, row_stream):
         for rows in slice_stream(row_stream, self.params.doc_batch_size):
-            yield [doc for row in rows for doc in self.row_to_docs(row)]
+            yield [part for row in rows for doc in self.row_to_docs(row) for part in self.split_doc(doc)]
+
+    def count_batch_chars(self, batch):
+        return sum(len(doc[key]) for doc in batch for key in doc if key != 'id')
 
     def row_to_docs(self, row):
         def join_cols(columns):
@@ -265,6 +357,76 @@ class AnalysisApp:
                 self.doc_type_to_segm['neg']: join_cols(self.params.neg_cols)
             }
 
+    def split_doc(self, doc):
+        if doc_size(doc) <= MAX_REQ_SIZE:
+            yield doc
+            return
+
+        doc_type = json.loads(doc['id'])[0]
+        segment = self.doc_type_to_segm[doc_type]
+        part_id = lambda index, count: json.dumps(['part', index, count, doc['id']])
+        text = doc[segment]
+        parts = split_text(text, MAX_REQ_SIZE - len(part_id(len(text), len(text))))
+        for index, part_text in enumerate(parts):
+            yield {
+                'id': part_id(index, len(parts)),
+                segment: part_text
+            }
+
+    def join_batch_parts(self, batch_analysis):
+        joined = []
+        parts_by_id = defaultdict(dict)
+        part_counts = dict()
+        for doc_analysis in batch_analysis:
+            doc_id = json.loads(doc_analysis['id'])
+            if doc_id[0] != 'part':
+                joined.append(doc_analysis)
+                continue
+            _, index, count, orig_id = doc_id
+            parts_by_id[orig_id][index] = doc_analysis
+            part_counts[orig_id] = count
+
+        for orig_id, parts in parts_by_id.items():
+            if len(parts) < part_counts[orig_id]:
+                print('failed to process some parts of the document: {id}'.format(id=orig_id), file=sys.stderr)
+                sys.stderr.flush()
+                continue
+            joined.append(self.join_doc_parts([parts[index] for index in sorted(parts)], orig_id))
+        return joined
+
+    def join_doc_parts(self, part_analyses, doc_id):
+        doc_type = json.loads(doc_id)[0]
+        segment = self.doc_type_to_segm[doc_type]
+        sentiment = self.join_sentiment(part_analyses)
+
+        doc_analysis = part_analyses[0]
+        doc_analysis['id'] = doc_id
+        for part_analysis in part_analyses[1:]:
+            if segment in doc_analysis and segment in part_analysis:
+                doc_analysis[segment] += part_analysis[segment]
+            self.merge_analysis(part_analysis, doc_analysis)
+        if sentiment:
+            doc_analysis['sentiment'] = sentiment
+        return doc_analysis
+
+    def join_sentiment(self, part_analyses):
+        weighted = [(max(int(a['usedChars']), 1), a['sentiment']) for a in part_analyses if 'sentiment' in a]
+        if not weighted:
+            return None
+        value = sum(w * s['value'] for w, s in weighted) / sum(w for w, _ in weighted)
+
+        # the polarity is voted by the parts, a tie is resolved as neutral
+        votes = defaultdict(int)
+        for w, s in weighted:
+            votes[s['polarity']] += w
+        polarity = max(votes, key=lambda p: (votes[p], p == 0))
+        label = next(s['label'] for _, s in weighted if s['polarity'] == polarity)
+        return {
+            'value': value,
+            'polarity': polarity,
+            'label': label
+        }
+
     def proc_batch_analysis(self, batch_analysis):
         grouped = defaultdict(dict)
         for doc_analysis in batch_analysis:
@@ -272,6 +434,10 @@ class AnalysisApp:
             grouped[tuple(ids)][doc_type] = doc_analysis
 
         for ids, analysis_by_type in grouped.items():
+            if 'txt' not in analysis_by_type:
+                print('skipping document with ID={id}, its text was not analyzed'.format(id=json.dumps(list(ids))), file=sys.stderr)
+                sys.stderr.flush()
+                continue
             doc_analysis = analysis_by_type['txt']
             doc_analysis['id'] = json.dumps(list(ids))
             self.proc_entities(doc_analysis['entities'], 'txt')
@@ -321,6 +487,9 @@ class AnalysisApp:
     def copy_analysis(self, source_analysis, target_analysis, doc_type):
         segment = self.doc_type_to_segm[doc_type]
         target_analysis[segment] = source_analysis[segment]
+        self.merge_analysis(source_analysis, target_analysis)
+
+    def merge_analysis(self, source_analysis, target_analysis):
         target_analysis['usedChars'] += source_analysis['usedChars']
         target_analysis['sentences'] += source_analysis['sentences']
 
@@ -7,16 +7,30 @@ import csv
 import itertools
 import json
 import pickle
+import random
+import re
 import sys
 
 from collections import deque
 
 import requests
 
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 MAX_REQ_SIZE = 100 * 1024
 CONNECT_TIMEOUT = 10.01
 READ_TIMEOUT = 128
 
+PARAGRAPH_END = re.compile(r'(\n\n)')
+SENTENCE_END = re.compile(r'([.!?])(?=\s)')
+
+RECORD_BATCH_SIZE = 10000
+
 csv.field_size_limit(1024 * MAX_REQ_SIZE)
 
 
@@ -44,32 +58,149 @@ def read_csv(input_file):
             sys.stderr.flush()
 
 
+def reservoir_stream(iterator, size, reservoir, *, rng=random):
+    for n, item in enumerate(iterator):
+        if n < size:
+            reservoir.append(item)
+        else:
+            k = rng.randint(0, n)
+            if k < size:
+                reservoir[k] = item
+        yield item
+
+
 def csv_writer(output_file, *, fields):
     writer = csv.DictWriter(output_file, fieldnames=fields, dialect='kbc')
     writer.writeheader()
     return writer
 
 
-def make_batch_request(batch, req_obj, *, url, user_key, doc_id_key='id', docs_key='documents', session=None):
-    size = sum(len(doc[key]) for doc in batch for key in doc)
-    if size > MAX_REQ_SIZE:
-        if len(batch) == 1:
+class ColumnarWriter:
+
+    def __init__(self, output_path, *, fields, fmt, types, dict_fields, batch_size):
+        arrow_types = {
+            'str': pyarrow.string(),
+            'int': pyarrow.int64(),
+            'float': pyarrow.float64(),
+            'bool': pyarrow.bool_()
+        }
+        self.schema = pyarrow.schema([
+            pyarrow.field(f, pyarrow.dictionary(pyarrow.int32(), pyarrow.string()) if f in dict_fields
+                          else arrow_types[types.get(f, 'str')])
+            for f in fields
+        ])
+        self.batch_size = batch_size
+        self.rows = []
+        if fmt == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(output_path, self.schema)
+        else:
+            # the IPC file format does not allow replacing the dictionaries between record batches
+            self.writer = pyarrow.ipc.new_stream(output_path, self.schema)
+
+    def writerows(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        rows = self.rows
+        full = len(rows) - len(rows) % self.batch_size
+        self.rows = rows[full:]
+        for start in range(0, full, self.batch_size):
+            self.write_batch(rows[start:start + self.batch_size])
+
+    def write_batch(self, rows):
+        batch = pyarrow.RecordBatch.from_arrays([
+            pyarrow.array([row.get(field.name) for row in rows], type=field.type)
+            for field in self.schema
+        ], schema=self.schema)
+        self.writer.write_batch(batch)
+
+    def close(self):
+        try:
+            self.flush()
+            rows = self.rows
+            self.rows = []
+            if rows:
+                self.write_batch(rows)
+        finally:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def columnar_writer(output_path, *, fields, fmt, types=None, dict_fields=(), batch_size=RECORD_BATCH_SIZE):
+    if pyarrow is None:
+        raise ValueError('the "{fmt}" output format requires the "pyarrow" package'.format(fmt=fmt))
+    return ColumnarWriter(output_path, fields=fields, fmt=fmt, types=types or {},
+                          dict_fields=set(dict_fields), batch_size=batch_size)
+
+
+def doc_size(doc):
+    return sum(len(doc[key]) for key in doc)
+
+
+def split_keep(pattern, text):
+    parts = pattern.split(text)
+    return [''.join(parts[i:i + 2]) for i in range(0, len(parts), 2)]
+
+
+def split_text(text, max_size):
+    pieces = []
+    for par in split_keep(PARAGRAPH_END, text):
+        if len(par) <= max_size:
+            pieces.append(par)
+            continue
+        for snt in split_keep(SENTENCE_END, par):
+            if len(snt) <= max_size:
+                pieces.append(snt)
+            else:
+                pieces.extend(snt[i:i + max_size] for i in range(0, len(snt), max_size))
+
+    chunks = []
+    chunk = ''
+    for piece in pieces:
+        if chunk and len(chunk) + len(piece) > max_size:
+            chunks.append(chunk)
+            chunk = ''
+        chunk += piece
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def pack_batch(batch, *, doc_id_key='id'):
+    chunk = []
+    chunk_size = 0
+    for doc in batch:
+        size = doc_size(doc)
+        if size > MAX_REQ_SIZE:
             print(
-                'skipping too large document with ID={id}'.format(id=batch[0][doc_id_key]),
+                'skipping too large document with ID={id}'.format(id=doc[doc_id_key]),
                 'the maximum allowed size is {max} bytes'.format(max=MAX_REQ_SIZE),
                 sep='\n', file=sys.stderr
             )
             sys.stderr.flush()
-            return []
+            continue
+        if chunk and chunk_size + size > MAX_REQ_SIZE:
+            yield chunk
+            chunk = []
+            chunk_size = 0
+        chunk.append(doc)
+        chunk_size += size
+    if chunk:
+        yield chunk
+
+
+def count_batch_requests(batch, *, doc_id_key='id'):
+    return sum(1 for _ in pack_batch(batch, doc_id_key=doc_id_key))
 
-        half = len(batch) // 2
-        return itertools.chain(
-            make_batch_request(batch[:half], req_obj, url=url,
-                user_key=user_key, doc_id_key=doc_id_key, docs_key=docs_key, session=session),
-            make_batch_request(batch[half:], req_obj, url=url,
-                user_key=user_key, doc_id_key=doc_id_key, docs_key=docs_key, session=session)
-        )
 
+def post_batch_request(batch, req_obj, *, url, user_key, doc_id_key='id', docs_key='documents', session=None):
     headers = {
         'Content-Type': 'application/json',
         'Authorization': 'user_key ' + user_key
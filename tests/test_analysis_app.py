@@ -0,0 +1,205 @@
+# coding=utf-8
+# Python 3
+
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tempfile
+import types
+import unittest
+
+from contextlib import redirect_stderr, redirect_stdout
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+try:
+    import keboola.docker
+except ImportError:
+    # the app only needs the KBC config reader in Params.init, which the tests replace
+    keboola = types.ModuleType('keboola')
+    keboola.docker = types.ModuleType('keboola.docker')
+    sys.modules['keboola'] = keboola
+    sys.modules['keboola.docker'] = keboola.docker
+
+import analysis_app
+
+from analysis_app import AnalysisApp, Params
+
+
+def make_app(**params):
+    app_params = types.SimpleNamespace(
+        customer_id='1', user_key='key', source_tab_path=None,
+        id_cols=['id'], txt_cols=['text'], pos_cols=['pos'], neg_cols=[],
+        feedback_entities={'product'}, feedback_relations=set(),
+        language=None, domain=None, correction='AGGRESSIVE', diacritization='yes', use_beta=False,
+        doc_batch_size=2, thread_count=2, reference_date=None, preview_rows=0
+    )
+    for key, val in params.items():
+        setattr(app_params, key, val)
+    with mock.patch.object(Params, 'init', return_value=app_params), \
+         mock.patch.object(AnalysisApp, 'validate_input'):
+        return AnalysisApp()
+
+
+def make_rows(count):
+    return [{'id': str(i), 'text': 'Comment number {i}.'.format(i=i), 'pos': 'good'} for i in range(count)]
+
+
+class PreviewTest(unittest.TestCase):
+
+    def setUp(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as in_tab:
+            self.source_tab_path = in_tab.name
+
+    def tearDown(self):
+        os.remove(self.source_tab_path)
+
+    def run_preview(self, *, row_count, preview_rows, thread_count, elapsed):
+        app = make_app(source_tab_path=self.source_tab_path, preview_rows=preview_rows,
+                       thread_count=thread_count, doc_batch_size=1)
+        out = io.StringIO()
+        with mock.patch.object(analysis_app, 'read_csv', return_value=iter(make_rows(row_count))), \
+             mock.patch.object(analysis_app.time, 'monotonic', side_effect=[100.0, 100.0 + elapsed]), \
+             mock.patch.object(app, 'analyze_to_tables', return_value=(preview_rows, 0)) as analyze_to_tables, \
+             redirect_stdout(out):
+            app.run()
+        self.assertEqual(len(list(analyze_to_tables.call_args[0][0])), min(row_count, preview_rows))
+        return out.getvalue()
+
+    def test_request_counts(self):
+        out = self.run_preview(row_count=10, preview_rows=4, thread_count=2, elapsed=8)
+        self.assertIn('would need 10 API requests', out)
+
+    def test_estimate_sample_below_thread_count(self):
+        # one sample request took 8s, 10 requests on 4 threads take 10 / 4 * 8s
+        out = self.run_preview(row_count=10, preview_rows=1, thread_count=4, elapsed=8)
+        self.assertIn('estimated time of the full analysis is 20 seconds', out)
+
+    def test_estimate_sample_above_thread_count(self):
+        # 4 sample requests on 2 threads took 8s, i.e. 4s per request
+        out = self.run_preview(row_count=10, preview_rows=4, thread_count=2, elapsed=8)
+        self.assertIn('estimated time of the full analysis is 20 seconds', out)
+
+    def test_estimate_total_below_thread_count(self):
+        out = self.run_preview(row_count=3, preview_rows=3, thread_count=8, elapsed=5)
+        self.assertIn('estimated time of the full analysis is 5 seconds', out)
+
+
+def make_long_text(count):
+    return ''.join('Sentence {i:05d} here. '.format(i=i) for i in range(count))
+
+
+class FakeApi:
+
+    def __init__(self, fail=lambda doc_id: False):
+        self.fail = fail
+        self.requests = []
+        self.lock = threading.Lock()
+        self.rng = random.Random(0)
+
+    def __call__(self, batch, req_obj, **kwargs):
+        with self.lock:
+            self.requests.append([doc['id'] for doc in batch])
+            delay = self.rng.random() / 100
+        time.sleep(delay)
+        if any(self.fail(doc['id']) for doc in batch):
+            return []
+        return [self.analyze(doc) for doc in batch]
+
+    @staticmethod
+    def analyze(doc):
+        segment = next(key for key in doc if key != 'id')
+        text = doc[segment]
+        return {
+            'id': doc['id'],
+            segment: text,
+            'language': 'en',
+            'usedChars': len(text),
+            'sentiment': {'value': 0.1, 'polarity': 0, 'label': 'neutral'},
+            'sentences': [{'segment': segment, 'text': snt.strip()} for snt in text.split('.') if snt.strip()],
+            'entities': [{'type': 'product', 'text': 'thing', 'score': 0.5, 'mentions': [{'text': 'thing'}]}],
+            'relations': []
+        }
+
+
+class AnalyzeTest(unittest.TestCase):
+
+    def analyze(self, rows, api, **params):
+        app = make_app(**params)
+        with mock.patch.object(analysis_app, 'post_batch_request', api):
+            return app, list(app.analyze(iter(rows)))
+
+    def test_oversized_document(self):
+        text = make_long_text(12000)
+        rows = [{'id': '1', 'text': text, 'pos': 'good'}]
+        api = FakeApi()
+        app, batches = self.analyze(rows, api)
+
+        self.assertEqual(len(batches), 1)
+        self.assertGreaterEqual(len(api.requests), 3)
+        part_ids = [json.loads(doc_id) for req in api.requests for doc_id in req if doc_id.startswith('["part"')]
+        self.assertEqual(len(part_ids), 3)
+        self.assertEqual(sorted(part_id[1] for part_id in part_ids), [0, 1, 2])
+
+        docs = list(app.proc_batch_analysis(batches[0]))
+        self.assertEqual(len(docs), 1)
+        doc = docs[0]
+        self.assertEqual(json.loads(doc['id']), ['1'])
+        self.assertEqual(doc['text'], text)
+        self.assertEqual(doc['title'], 'good')
+        self.assertEqual(doc['usedChars'], len(text) + len('good'))
+        self.assertEqual([snt['text'] for snt in doc['sentences'] if snt['segment'] == 'text'],
+                         ['Sentence {i:05d} here'.format(i=i) for i in range(12000)])
+        self.assertEqual(doc['sentiment']['label'], 'neutral')
+        product = [ent for ent in doc['entities'] if ent['type'] == 'product']
+        self.assertEqual(len(product), 1)
+        self.assertEqual(len(product[0]['mentions']), 4)
+
+    def test_batches_with_different_chunk_counts(self):
+        long_rows = {3: 12000, 4: 6000, 6: 18000}
+        rows = [
+            {'id': str(i), 'text': make_long_text(long_rows[i]) if i in long_rows else 'Short {i}.'.format(i=i), 'pos': 'good'}
+            for i in range(10)
+        ]
+        api = FakeApi()
+        _, batches = self.analyze(rows, api, doc_batch_size=2, thread_count=3)
+
+        self.assertEqual(len(batches), 5)
+        for index, batch_analysis in enumerate(batches):
+            row_ids = [str(2 * index), str(2 * index + 1)]
+            self.assertEqual(sorted(json.loads(doc['id']) for doc in batch_analysis),
+                             sorted([doc_type, row_id] for row_id in row_ids for doc_type in ('pos', 'txt')))
+        txt_by_id = {json.loads(doc['id'])[1]: doc for batch in batches for doc in batch if doc['id'].startswith('["txt"')}
+        for i, row in enumerate(rows):
+            self.assertEqual(txt_by_id[str(i)]['text'], row['text'])
+
+    def failed_part_batch(self):
+        rows = [{'id': '1', 'text': make_long_text(12000), 'pos': 'good'}]
+        api = FakeApi(fail=lambda doc_id: doc_id.startswith('["part", 1,'))
+        err = io.StringIO()
+        with redirect_stderr(err):
+            app, batches = self.analyze(rows, api)
+        return app, batches, err.getvalue()
+
+    def test_failed_part_drops_document(self):
+        _, batches, err = self.failed_part_batch()
+        self.assertIn('failed to process some parts of the document', err)
+        self.assertEqual(len(batches), 1)
+        self.assertEqual([json.loads(doc['id']) for doc in batches[0]], [['pos', '1']])
+
+    def test_failed_text_skips_row(self):
+        app, batches, _ = self.failed_part_batch()
+        err = io.StringIO()
+        with redirect_stderr(err):
+            docs = list(app.proc_batch_analysis(batches[0]))
+        self.assertEqual(docs, [])
+        self.assertIn('skipping document with ID=["1"]', err.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
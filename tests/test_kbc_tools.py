@@ -0,0 +1,148 @@
+# coding=utf-8
+# Python 3
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from kbc_tools import split_text, columnar_writer, reservoir_stream, pack_batch, count_batch_requests, MAX_REQ_SIZE
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class ReservoirStreamTest(unittest.TestCase):
+
+    def sample(self, count, size):
+        reservoir = []
+        passed = list(reservoir_stream(iter(range(count)), size, reservoir, rng=random.Random(42)))
+        self.assertEqual(passed, list(range(count)))
+        return reservoir
+
+    def test_fewer_items(self):
+        self.assertEqual(self.sample(3, 5), [0, 1, 2])
+
+    def test_exact_items(self):
+        self.assertEqual(self.sample(5, 5), [0, 1, 2, 3, 4])
+
+    def test_more_items(self):
+        reservoir = self.sample(1000, 5)
+        self.assertEqual(len(reservoir), 5)
+        self.assertEqual(len(set(reservoir)), 5)
+        self.assertTrue(all(0 <= item < 1000 for item in reservoir))
+        self.assertNotEqual(reservoir, [0, 1, 2, 3, 4])
+        self.assertEqual(reservoir, self.sample(1000, 5))
+
+
+class CountBatchRequestsTest(unittest.TestCase):
+
+    def test_matches_pack_batch(self):
+        batches = [
+            [],
+            [{'id': '1', 'text': 'short'}],
+            [{'id': str(i), 'text': 'x' * (MAX_REQ_SIZE // 3)} for i in range(7)],
+            [{'id': '1', 'text': 'x' * 10}, {'id': '2', 'text': 'x' * (2 * MAX_REQ_SIZE)}, {'id': '3', 'text': 'x'}]
+        ]
+        for batch in batches:
+            self.assertEqual(count_batch_requests(batch), len(list(pack_batch(batch))))
+        self.assertEqual(count_batch_requests(batches[2]), 4)
+        self.assertEqual(count_batch_requests(batches[3]), 1)
+
+
+class SplitTextTest(unittest.TestCase):
+
+    def test_short_text(self):
+        self.assertEqual(split_text('Hello there.', 20), ['Hello there.'])
+
+    def test_paragraph_and_sentence_boundaries(self):
+        text = 'Hello there. How are you?\n\nNew para! ' + 'x' * 50 + ' end.'
+        chunks = split_text(text, 20)
+        self.assertEqual(''.join(chunks), text)
+        self.assertTrue(all(len(chunk) <= 20 for chunk in chunks))
+        self.assertEqual(chunks[:3], ['Hello there.', ' How are you?\n\n', 'New para!'])
+
+    def test_empty_text(self):
+        self.assertEqual(split_text('', 20), [])
+
+
+@unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+class ColumnarWriterTest(unittest.TestCase):
+
+    FIELDS = ['id', 'type', 'score', 'sentimentLabel']
+    ROWS = [
+        {'id': '1', 'type': 'product', 'score': 0.5, 'sentimentLabel': 'positive'},
+        {'id': '2', 'type': 'service', 'score': 1.0, 'sentimentLabel': None},
+        {'id': '3', 'type': 'tag', 'score': None, 'sentimentLabel': 'negative'},
+        {'id': '4', 'type': 'product', 'score': 0.1, 'sentimentLabel': 'neutral'},
+        {'id': '5', 'type': 'person', 'score': 0.2, 'sentimentLabel': 'positive'}
+    ]
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def write_rows(self, fmt, chunks):
+        path = os.path.join(self.out_dir, 'tab.' + fmt)
+        with columnar_writer(path, fields=self.FIELDS, fmt=fmt, types={'score': 'float'},
+                             dict_fields=('type', 'sentimentLabel'), batch_size=2) as writer:
+            for start, end in chunks:
+                writer.writerows(self.ROWS[start:end])
+        return path
+
+    def read_stream(self, path):
+        with pyarrow.OSFile(path, 'rb') as source:
+            return list(pyarrow.ipc.open_stream(source))
+
+    def assert_table(self, table):
+        self.assertTrue(pyarrow.types.is_dictionary(table.schema.field('type').type))
+        self.assertTrue(pyarrow.types.is_dictionary(table.schema.field('sentimentLabel').type))
+        self.assertTrue(pyarrow.types.is_float64(table.schema.field('score').type))
+        self.assertEqual(table.to_pylist(), self.ROWS)
+
+    def assert_parquet(self, chunks, batch_sizes):
+        path = self.write_rows('parquet', chunks)
+        metadata = pyarrow.parquet.ParquetFile(path).metadata
+        self.assertEqual([metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)], batch_sizes)
+        self.assert_table(pyarrow.parquet.read_table(path))
+
+    def assert_arrow(self, chunks, batch_sizes):
+        path = self.write_rows('arrow', chunks)
+        batches = self.read_stream(path)
+        self.assertEqual([batch.num_rows for batch in batches], batch_sizes)
+        self.assert_table(pyarrow.Table.from_batches(batches))
+
+    def test_parquet_multiple_batches(self):
+        self.assert_parquet([(0, 1), (1, 4), (4, 5)], [2, 2, 1])
+
+    def test_parquet_single_write(self):
+        self.assert_parquet([(0, 5)], [2, 2, 1])
+
+    def test_arrow_multiple_batches(self):
+        self.assert_arrow([(0, 1), (1, 4), (4, 5)], [2, 2, 1])
+
+    def test_arrow_single_write(self):
+        self.assert_arrow([(0, 5)], [2, 2, 1])
+
+    def test_close_after_failed_write(self):
+        path = os.path.join(self.out_dir, 'tab.arrow')
+        writer = columnar_writer(path, fields=['score'], fmt='arrow', types={'score': 'float'})
+        writer.writerows([{'score': 'invalid'}])
+        with self.assertRaises(pyarrow.ArrowException):
+            writer.close()
+        self.assertEqual(writer.rows, [])
+        self.assertEqual(self.read_stream(path), [])
+
+
+if __name__ == '__main__':
+    unittest.main()